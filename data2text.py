@@ -8,6 +8,7 @@ import logging
 import argparse
 import datetime
 import nltk
+import torch
 from os import path, makedirs
 from extractor import (train_extractor, eval_extractor, load_extractor,
                        extractor_is_available)
@@ -124,6 +125,11 @@ if __name__ == "__main__":
     # download the nltk tokenizers if they aren't already present
     nltk.download('punkt', download_dir='./', quiet=True)
 
+    # let cudnn pick the fastest kernels and allow tf32 math on ampere (and newer) gpus
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
     if args.command == "evaluate":
         corpus = args.corpus == "test"
         if args.stage == "extractor":
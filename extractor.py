@@ -14,7 +14,7 @@ from ignite.metrics import Accuracy, Recall
 from util.extractor import load_extractor_data
 from abc import abstractmethod, ABC
 from os import path, makedirs
-from util.constants import device
+from util.device import device
 from util.helper_funcs import to_device
 
 
@@ -154,7 +154,9 @@ class CNNExtractor(Extractor):
 def train_extractor(batch_size=32, epochs=10, learning_rate=0.1, decay=0.5, clip=5, log_interval=1000, cnn=False):
     prefix, Model = ("cnn", CNNExtractor) if cnn else ("lstm", LSTMExtractor)
     data = load_extractor_data("train")
-    loader = DataLoader(data, shuffle=True, batch_size=batch_size, pin_memory=torch.cuda.is_available())
+    # batches are assembled and pinned by background workers, so that the host to device copies can overlap
+    loader = DataLoader(data, shuffle=True, batch_size=batch_size, num_workers=4, persistent_workers=True,
+                        prefetch_factor=4, pin_memory=torch.cuda.is_available())
     loss_fn = MarginalNLLLoss()
 
     extractor = Model(data.stats["n_words"], data.stats["ent_len"], data.stats["num_len"], num_types=data.stats["n_types"]).to(device)
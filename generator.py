@@ -8,15 +8,17 @@ import torch.nn.functional as F
 import logging
 import copy
 from torch import optim
-from random import random
 from torch.utils.data import DataLoader
+from torch.cuda.amp import autocast, GradScaler
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from ignite.engine import Engine, Events
 from ignite.handlers import ModelCheckpoint
 from util.generator import load_generator_data
-from util.constants import PAD_WORD, BOS_WORD, EOS_WORD
 from os import path, makedirs
-from util.constants import device, TEXT_MAX_LENGTH
-from util.helper_funcs import to_device
+from util.constants import TEXT_MAX_LENGTH, SYNC_INTERVAL
+from util.device import device
+from util.helper_funcs import to_device, special_ids
+from util.cuda_graph import CUDAGraphStep
 from util.metrics import CSMetric, RGMetric, COMetric, BleuScore
 
 
@@ -24,11 +26,17 @@ class TextGenerator(nn.Module):
     def __init__(self, record_encoder, word_input_size, word_hidden_size=600, hidden_size=600):
         super().__init__()
         self.encoded = None
+        self.enc_lin = None
+        self.mask = None
+        # optional static buffers for the encoder outputs, see allocate_buffers
+        self.register_buffer("encoded_buf", None, persistent=False)
+        self.register_buffer("enc_lin_buf", None, persistent=False)
+        self.register_buffer("mask_buf", None, persistent=False)
 
         self.record_encoder = record_encoder
         self.embedding = nn.Embedding(word_input_size, word_hidden_size)
         self.encoder_rnn = nn.LSTM(self.record_encoder.hidden_size, hidden_size, batch_first=True, bidirectional=True)
-        self.decoder_rnn = nn.LSTM(word_hidden_size, hidden_size, batch_first=True, bidirectional=True)
+        self.decoder_rnn = nn.LSTM(word_hidden_size, 2 * hidden_size, batch_first=True)
         self.linear = nn.Linear(2 * hidden_size, 2 * hidden_size, bias=False)
         self.tanh_mlp = nn.Sequential(
             nn.Linear(4 * hidden_size, 2 * hidden_size, bias=False),
@@ -36,100 +44,173 @@ class TextGenerator(nn.Module):
         self.soft_mlp = nn.Sequential(
             nn.Linear(2 * hidden_size, word_input_size),
             nn.LogSoftmax(dim=2))
+        # only the logits of the copy gate, the sigmoid is applied by the loss or during inference
         self.sig_copy = nn.Sequential(
-            nn.Linear(2 * hidden_size, 1),
-            nn.Sigmoid())
+            nn.Linear(2 * hidden_size, 1))
 
     def forward(self, word, hidden, cell):
         """
-        Content Planning. Uses attention to create pointers to the input records.
+        Text Generation. Uses attention to create pointers to the input records.
+        Word is either one word per batch entry or a whole sequence of words (e.g. for teacher forcing).
         """
-        # shape = (batch_size, 1, word_hidden_size)
-        embedded = self.embedding(word).unsqueeze(1)
-        # output.shape = (batch_size, seq_len, 2 * hidden_size)
+        # shape = (batch_size, steps, word_hidden_size)
+        embedded = self.embedding(word.view(word.size(0), -1))
+        # output.shape = (batch_size, steps, 2 * hidden_size)
         output, (new_hidden, new_cell) = self.decoder_rnn(embedded, (hidden, cell))
-        # shape = (batch_size, 2 * hidden_size, seq_len)
-        enc_lin = self.linear(self.encoded).transpose(1, 2)
-        # shape = (batch_size, 1, seq_len)
-        energy = torch.bmm(output, enc_lin)
-        # shape = (batch_size, 1, 2 * hidden_size)
-        selected = torch.bmm(F.softmax(energy, dim=2), self.encoded)
+        # shape = (batch_size, steps, seq_len)
+        energy = torch.bmm(output, self.enc_lin)
+        # ignore the padded records of shorter content plans in a batch
+        energy = energy.masked_fill(~self.mask, float("-inf"))
+        log_attention = F.log_softmax(energy, dim=2)
+        # shape = (batch_size, steps, 2 * hidden_size)
+        selected = torch.bmm(log_attention.exp(), self.encoded)
 
         att_hidden = self.tanh_mlp(torch.cat((output, selected), dim=2))
         out_prob = self.soft_mlp(att_hidden).squeeze(1)
-        p_copy = self.sig_copy(output).squeeze(1)
-        log_attention = F.log_softmax(energy, dim=2).squeeze(1)
+        copy_logit = self.sig_copy(output).squeeze(1)
 
-        return out_prob, log_attention, p_copy, new_hidden, new_cell
+        return out_prob, log_attention.squeeze(1), copy_logit, new_hidden, new_cell
 
-    def init_hidden(self, records, content_plan):
+    def init_hidden(self, records, content_plan, lengths):
         """
         Compute the initial hidden state and cell state of the Content Planning LSTM.
         Use an RNN to encode the record representations from the planning stage record encoder.
+        Lengths contains the number of records in each (padded) content plan.
         """
+        lengths = lengths.cpu()
         self.record_encoder(records)
         encoded_records = self.record_encoder.get_encodings(content_plan)
+        # padded records are skipped by the encoder
+        packed_records = pack_padded_sequence(encoded_records, lengths, batch_first=True, enforce_sorted=False)
+        packed_encoded, (hidden, cell) = self.encoder_rnn(packed_records)
         # encoded.shape = (batch_size, seq_len, 2 * hidden_size)
-        self.encoded, (hidden, cell) = self.encoder_rnn(encoded_records)
+        encoded, _ = pad_packed_sequence(packed_encoded, batch_first=True, total_length=content_plan.size(1))
+        # shape = (batch_size, 1, seq_len)
+        positions = torch.arange(content_plan.size(1), device=content_plan.device)
+        mask = (positions < lengths.to(content_plan.device).unsqueeze(1)).unsqueeze(1)
+        # concatenate both directions of the encoder for the unidirectional decoder
+        # shape = (1, batch_size, 2 * hidden_size)
+        hidden = torch.cat((hidden[0], hidden[1]), dim=1).unsqueeze(0)
+        cell = torch.cat((cell[0], cell[1]), dim=1).unsqueeze(0)
+        # the projection of the encoded records stays the same for every decoding step
+        # shape = (batch_size, 2 * hidden_size, seq_len)
+        enc_lin = self.linear(encoded).transpose(1, 2)
+
+        if self.encoded_buf is None:
+            self.encoded, self.enc_lin, self.mask = encoded, enc_lin.contiguous(), mask
+        else:
+            # the buffers are longer than the content plans, the remaining positions are zeroed and masked out
+            batch_size, seq_len = content_plan.shape
+            self.encoded = self.encoded_buf[:batch_size].zero_()
+            self.encoded[:, :seq_len].copy_(encoded)
+            self.enc_lin = self.enc_lin_buf[:batch_size].zero_()
+            self.enc_lin[:, :, :seq_len].copy_(enc_lin)
+            self.mask = self.mask_buf[:batch_size].zero_()
+            self.mask[:, :, :seq_len].copy_(mask)
         return hidden, cell
 
+    def allocate_buffers(self, batch_size, seq_len):
+        """
+        Keep the encoder outputs of init_hidden in preallocated buffers, so that their memory stays the same
+        across batches and captured cuda graphs can be replayed. Only meant for inference.
+        """
+        param = next(self.parameters())
+        size = self.linear.in_features
+        self.encoded_buf = torch.zeros(batch_size, seq_len, size, dtype=param.dtype, device=param.device)
+        self.enc_lin_buf = torch.zeros(batch_size, size, seq_len, dtype=param.dtype, device=param.device)
+        self.mask_buf = torch.zeros(batch_size, 1, seq_len, dtype=torch.bool, device=param.device)
+
+    def free_buffers(self):
+        """
+        Go back to allocating new tensors for the encoder outputs on every call of init_hidden.
+        """
+        self.encoded_buf = self.enc_lin_buf = self.mask_buf = None
+
 
 ###############################################################################
 # Training & Evaluation functions                                             #
 ###############################################################################
 
 
-def train_generator(extractor, content_planner, epochs=25, learning_rate=0.15, acc_val_init=0.1,
+def train_generator(extractor, content_planner, batch_size=32, epochs=25, learning_rate=0.15, acc_val_init=0.1,
                     clip=7, teacher_forcing_ratio=1.0, log_interval=100):
     data = load_generator_data("train", extractor, content_planner, planner=True)
-    loader = DataLoader(data, shuffle=True, pin_memory=torch.cuda.is_available())  # online learning
+    # batches are assembled and pinned by background workers, so that the host to device copies can overlap
+    loader = DataLoader(data, shuffle=True, batch_size=batch_size, collate_fn=data.collate, num_workers=4,
+                        persistent_workers=True, prefetch_factor=4, pin_memory=torch.cuda.is_available())
 
     generator = TextGenerator(copy.deepcopy(content_planner.record_encoder), len(data.idx2word)).to(device)
+    # compile the forward pass on the gpu where supported, the uncompiled module is still used for everything else
+    decoder = generator
+    if torch.cuda.is_available() and hasattr(torch, "compile"):
+        decoder = torch.compile(generator)
     optimizer = optim.Adagrad(generator.parameters(), lr=learning_rate, initial_accumulator_value=acc_val_init)
+    # use mixed precision when training on the gpu
+    scaler = GradScaler(enabled=torch.cuda.is_available())
 
     logging.info("Training a new Text Generator...")
 
+    pad, _, _, _ = special_ids(data.vocab)
+
+    def _loss(out_prob, copy_prob, copy_logit, words, copy_tgts, copy_indices):
+        """
+        Compute the summed loss over one or more time steps and ignore padded words.
+        The loss is computed in full precision and the copy gate works on logits, as a sigmoid in half precision
+        saturates and its binary cross entropy overflows.
+        """
+        words, copy_tgts, copy_indices = words.reshape(-1), copy_tgts.reshape(-1), copy_indices.reshape(-1)
+        copy_mask = copy_tgts.bool()
+        with autocast(enabled=False):
+            loss = F.binary_cross_entropy_with_logits(copy_logit.reshape(-1).float(), copy_tgts, reduction="none")
+            loss += F.nll_loss(copy_prob.reshape(words.size(0), -1), copy_indices, reduction="none") * copy_mask
+            loss += F.nll_loss(out_prob.reshape(words.size(0), -1), words, reduction="none") * ~copy_mask
+        return (loss * (words != pad)).sum()
+
     def _update(engine, batch):
         """
         Update function for the Text Generation Module.
-        Right now only online learning is supported
+        Summaries of different length in a mini-batch are handled with masks.
         """
         generator.train()
-        optimizer.zero_grad()
-        use_teacher_forcing = True if random() < teacher_forcing_ratio else False
+        optimizer.zero_grad(set_to_none=True)
+        *batch, plan_lengths = batch
         text, copy_tgts, records, content_plan, copy_indices, copy_values = to_device(batch)
-        # remove all the zero padded values from content plans
-        content_plan = content_plan[:, :(content_plan > data.vocab[PAD_WORD]).sum(dim=1)]
-        hidden, cell = generator.init_hidden(records, content_plan)
-        text_iter, copy_index_iter = zip(text.t(), copy_tgts.t()), iter(copy_indices.t())
-        input_word, _ = next(text_iter)
-
-        loss = 0
-        len_sequence = 0
-
-        for word, copy_tgt in text_iter:
-            if word.cpu() == data.vocab[PAD_WORD]:
-                break
-            out_prob, copy_prob, p_copy, hidden, cell = generator(
-                input_word, hidden, cell)
-            loss += F.binary_cross_entropy(p_copy, copy_tgt.view(-1, 1))
-            if copy_tgt:
-                loss += F.nll_loss(copy_prob, next(copy_index_iter))
-            else:
-                loss += F.nll_loss(out_prob, word)
-            len_sequence += 1
-            if use_teacher_forcing:
-                input_word = word
+        num_tokens = (text[:, 1:] != pad).sum()
+
+        with autocast(enabled=torch.cuda.is_available()):
+            hidden, cell = generator.init_hidden(records, content_plan, plan_lengths)
+            if teacher_forcing_ratio >= 1:
+                # the input words are known in advance, so all time steps are processed at once
+                out_prob, copy_prob, copy_logit, _, _ = decoder(text[:, :-1], hidden, cell)
+                loss = _loss(out_prob, copy_prob, copy_logit, text[:, 1:], copy_tgts[:, 1:], copy_indices[:, 1:])
             else:
-                if p_copy.round():
-                    input_word = copy_values[:, copy_prob.argmax(dim=1)].view(-1).detach()
-                else:
-                    input_word = out_prob.argmax(dim=1).detach()
-
-        loss.backward()
+                losses = list()
+                # time major copies, so that every time step is a contiguous slice
+                words, step_copy_tgts, step_copy_indices = (text.t().contiguous(), copy_tgts.t().contiguous(),
+                                                            copy_indices.t().contiguous())
+                input_word = words[0]
+                # decide for every time step whether the gold word or the prediction is the next input
+                teacher_forcing = torch.rand(text.size(1), device=device) < teacher_forcing_ratio
+                for t in range(1, text.size(1)):
+                    out_prob, copy_prob, copy_logit, hidden, cell = decoder(
+                        input_word, hidden, cell)
+                    losses.append(_loss(out_prob, copy_prob, copy_logit, words[t], step_copy_tgts[t],
+                                        step_copy_indices[t]))
+                    copied_word = copy_values.gather(1, copy_prob.argmax(dim=1, keepdim=True)).view(-1)
+                    p_copy = torch.sigmoid(copy_logit.view(-1))
+                    predicted_word = torch.where(p_copy > 0.5, copied_word, out_prob.argmax(dim=1)).detach()
+                    input_word = torch.where(teacher_forcing[t], words[t], predicted_word)
+                # sum all step losses at once to keep the autograd graph flat
+                loss = torch.stack(losses).sum()
+
+        # average the summed loss of every sequence, so that the gradients keep the per sequence scale that the
+        # learning rate, initial accumulator value and clipping were tuned for
+        scaler.scale(loss / text.size(0)).backward()
+        scaler.unscale_(optimizer)
         nn.utils.clip_grad_norm_(generator.parameters(), clip)
-        optimizer.step()
-        return loss.item() / len_sequence  # normalize loss for logging
+        scaler.step(optimizer)
+        scaler.update()
+        return (loss / num_tokens).item()  # normalize loss for logging
 
     trainer = Engine(_update)
     # save the model every 4 epochs
@@ -167,17 +248,17 @@ def train_generator(extractor, content_planner, epochs=25, learning_rate=0.15, a
     return generator.cpu()
 
 
-def eval_generator(extractor, content_planner, generator, test=False, planner=False):
+def eval_generator(extractor, content_planner, generator, test=False, planner=False, batch_size=32):
     generator = generator.to(device)
     prefix = "" if planner else " (without planner)"
     if test:
         used_set = "Test"
         data = load_generator_data("test", extractor, content_planner, planner=planner)
-        loader = DataLoader(data)
+        loader = DataLoader(data, batch_size=batch_size, collate_fn=data.collate)
     else:
         used_set = "Validation"
         data = load_generator_data("valid", extractor, content_planner, planner=planner)
-        loader = DataLoader(data)
+        loader = DataLoader(data, batch_size=batch_size, collate_fn=data.collate)
 
     def _evaluate():
         generator.eval()
@@ -185,33 +266,51 @@ def eval_generator(extractor, content_planner, generator, test=False, planner=Fa
         rg_metric = RGMetric(extractor, "test" if test else "valid")
         co_metric = COMetric(extractor, "test" if test else "valid")
         bleu_metric = BleuScore()
-        for idx, batch in enumerate(loader):
+        pad, _, bos, eos = special_ids(data.vocab)
+        special_words = (bos, eos, pad)
+        idx = 0
+        # on the gpu cuda graphs can be reused for batches of the same size, as the encoder outputs live in static
+        # buffers, which only need to be as wide as the longest content plan
+        use_graphs = torch.cuda.is_available()
+        graphs = dict()
+        if use_graphs:
+            generator.allocate_buffers(batch_size, data.plan_lengths.max().item())
+        for *batch, plan_lengths in loader:
             gold_text, _, records, content_plan, _, copy_values = to_device(batch)
-            # remove all the zero padded values from content plans
-            content_plan = content_plan[:, :(content_plan > data.vocab[PAD_WORD]).sum(dim=1)]
-            hidden, cell = generator.init_hidden(records, content_plan)
-            input_word = torch.tensor([data.vocab[BOS_WORD]]).to(device, non_blocking=True)
-            text = [input_word.item()]
+            input_word = torch.full((len(gold_text),), bos, dtype=torch.long, device=device)
+            # every summary of the batch stays alive until it produced its end of sequence token
+            alive = torch.ones_like(input_word, dtype=torch.bool)
+            text = list()
 
             with torch.no_grad():
-                while input_word.cpu() != data.vocab[EOS_WORD] and len(text) <= TEXT_MAX_LENGTH:
-                    out_prob, copy_prob, p_copy, hidden, cell = generator(
+                hidden, cell = generator.init_hidden(records, content_plan, plan_lengths)
+                # on the gpu replay the decoding steps from a cuda graph
+                if use_graphs and len(input_word) not in graphs:
+                    graphs[len(input_word)] = CUDAGraphStep(generator, input_word, hidden, cell)
+                decode = graphs.get(len(input_word), generator)
+                for step in range(1, TEXT_MAX_LENGTH + 1):
+                    out_prob, copy_prob, copy_logit, hidden, cell = decode(
                         input_word, hidden, cell)
-                    if p_copy.round():
-                        input_word = copy_values[:, copy_prob.argmax(dim=1)].view(1)
-                    else:
-                        input_word = out_prob.argmax(dim=1)
-                    text.append(input_word.item())
-            # convert indices to readable summaries
-            gold_sum = [data.idx2word[idx.item()] for idx in gold_text[0] if
-                        idx not in (data.vocab[BOS_WORD], data.vocab[EOS_WORD],
-                        data.vocab[PAD_WORD])]
-            gen_sum = [data.idx2word[idx] for idx in text[1:-1]]
-            # feed summaries into all metrics
-            cs_metric(gen_sum, gold_sum, data.idx_list[idx])
-            co_metric(gen_sum, gold_sum, data.idx_list[idx])
-            rg_metric(gen_sum, data.idx_list[idx])
-            bleu_metric(gold_sum, gen_sum)
+                    copied_word = copy_values.gather(1, copy_prob.argmax(dim=1, keepdim=True)).view(-1)
+                    p_copy = torch.sigmoid(copy_logit.view(-1))
+                    input_word = torch.where(p_copy > 0.5, copied_word, out_prob.argmax(dim=1))
+                    text.append(input_word)
+                    alive &= input_word != eos
+                    # only synchronize with the gpu every few steps to check if all summaries are finished
+                    if step % SYNC_INTERVAL == 0 and not alive.any():
+                        break
+
+            for gold, gen in zip(gold_text.tolist(), torch.stack(text, dim=1).tolist()):
+                # convert indices to readable summaries
+                gold_sum = [data.idx2word[word] for word in gold if word not in special_words]
+                gen_sum = [data.idx2word[word] for word in gen[:gen.index(eos) if eos in gen else -1]]
+                # feed summaries into all metrics
+                cs_metric(gen_sum, gold_sum, data.idx_list[idx])
+                co_metric(gen_sum, gold_sum, data.idx_list[idx])
+                rg_metric(gen_sum, data.idx_list[idx])
+                bleu_metric(gold_sum, gen_sum)
+                idx += 1
+        generator.free_buffers()
 
         logging.info("{}{} Results - CS Precision: {:.4f}%, CS Recall: {:.4f}%"
                      .format(used_set, prefix, *cs_metric.calculate()))
@@ -234,9 +333,32 @@ def generator_is_available():
         return False
 
 
+def convert_bidirectional_decoder(state_dict):
+    """
+    Convert the bidirectional decoder of generators that were saved before it became unidirectional.
+    Both directions were only ever fed single words, so they are equivalent to one LSTM with twice the hidden size,
+    whose first half of the hidden state is the forward and the second half the backward direction.
+    """
+    if "decoder_rnn.weight_ih_l0_reverse" not in state_dict:
+        return state_dict
+    state_dict = state_dict.copy()
+    for name in ("weight_ih", "weight_hh", "bias_ih", "bias_hh"):
+        forward = state_dict.pop(f"decoder_rnn.{name}_l0")
+        backward = state_dict.pop(f"decoder_rnn.{name}_l0_reverse")
+        if name == "weight_hh":
+            # every direction only depends on its own half of the hidden state
+            forward = torch.cat((forward, torch.zeros_like(forward)), dim=1)
+            backward = torch.cat((torch.zeros_like(backward), backward), dim=1)
+        # interleave both directions gate by gate (input, forget, cell, output)
+        state_dict[f"decoder_rnn.{name}_l0"] = torch.cat(
+            [gate for gates in zip(forward.chunk(4), backward.chunk(4)) for gate in gates])
+    return state_dict
+
+
 def load_generator(extractor, content_planner):
     if path.exists("models/text_generator.pt"):
         data = load_generator_data("train", extractor, content_planner, planner=True)
         generator = TextGenerator(copy.deepcopy(content_planner.record_encoder), len(data.idx2word))
-        generator.load_state_dict(torch.load("models/text_generator.pt", map_location="cpu"))
+        generator.load_state_dict(convert_bidirectional_decoder(torch.load("models/text_generator.pt",
+                                                                           map_location="cpu")))
         return generator
@@ -7,15 +7,16 @@ import torch.nn as nn
 import torch.nn.functional as F
 import logging
 from torch import optim
-from random import random
 from torch.utils.data import DataLoader
+from torch.cuda.amp import autocast, GradScaler
 from ignite.engine import Engine, Events
 from ignite.handlers import ModelCheckpoint
 from util.planner import load_planner_data
-from util.constants import BOS_WORD, EOS_WORD, PAD_WORD
 from os import path, makedirs
-from util.constants import device
-from util.helper_funcs import to_device
+from util.constants import SYNC_INTERVAL
+from util.device import device
+from util.helper_funcs import to_device, special_ids
+from util.cuda_graph import CUDAGraphStep
 from util.metrics import BleuScore
 
 
@@ -65,7 +66,7 @@ class RecordEncoder(nn.Module):
         Get the record representations at the specified indices.
         """
         # size = (batch_size, indices) => size = (batch_size, indices, hidden_size)
-        index = index.unsqueeze(2).repeat(1, 1, self.hidden_size)
+        index = index.unsqueeze(2).expand(-1, -1, self.hidden_size)
         records = self.encoded.gather(1, index)
 
         return records
@@ -76,6 +77,10 @@ class ContentPlanner(nn.Module):
         super(ContentPlanner, self).__init__()
         self.hidden_size = hidden_size
         self.selected_content = None
+        self.content_tp = None
+        # optional static buffers for the encoded records, see allocate_buffers
+        self.register_buffer("selected_content_buf", None, persistent=False)
+        self.register_buffer("content_tp_buf", None, persistent=False)
 
         self.record_encoder = RecordEncoder(input_size, hidden_size)
         self.rnn = nn.LSTM(hidden_size, hidden_size, batch_first=True)
@@ -84,18 +89,17 @@ class ContentPlanner(nn.Module):
     def forward(self, index, hidden, cell):
         """
         Content Planning. Uses attention to create pointers to the input records.
+        Index is either one record per batch entry or a whole sequence of records (e.g. for teacher forcing).
         """
-        # size = (batch_size) => size = (batch_size, 1, hidden_size)
-        index = index.view(-1, 1, 1).repeat(1, 1, self.hidden_size)
+        # size = (batch_size, steps) => size = (batch_size, steps, hidden_size)
+        index = index.view(index.size(0), -1, 1).expand(-1, -1, self.hidden_size)
         input_ = self.selected_content.gather(1, index)
 
-        # size = (batch_size, 1, hidden_size)
+        # size = (batch_size, steps, hidden_size)
         output, (hidden, cell) = self.rnn(input_, (hidden, cell))
-        # size = (batch_size, hidden_size, records)
-        content_tp = self.linear(self.selected_content).transpose(1, 2)
-        # size = (batch_size, 1, records)
-        logits = torch.bmm(output, content_tp)
-        # size = (batch_size, records)
+        # size = (batch_size, steps, records)
+        logits = torch.bmm(output, self.content_tp)
+        # size = (batch_size, records) if steps == 1 else (batch_size, steps, records)
         attention = F.log_softmax(logits, dim=2).squeeze(1)
 
         return attention, hidden, cell
@@ -104,59 +108,110 @@ class ContentPlanner(nn.Module):
         """
         Compute the initial hidden state and cell state of the Content Planning LSTM.
         """
-        self.selected_content = self.record_encoder(records)
+        selected_content = self.record_encoder(records)
+        # the projection of the selected content stays the same for every decoding step
+        # size = (batch_size, hidden_size, records)
+        content_tp = self.linear(selected_content).transpose(1, 2)
+        if self.selected_content_buf is None:
+            self.selected_content, self.content_tp = selected_content, content_tp.contiguous()
+        else:
+            self.selected_content = self.selected_content_buf[:records.size(0)].copy_(selected_content)
+            self.content_tp = self.content_tp_buf[:records.size(0)].copy_(content_tp)
         # transpose first and second dim, because LSTM expects seq_len first
         hidden = torch.mean(self.selected_content, dim=1, keepdim=True).transpose(0, 1)
         cell = torch.zeros_like(hidden)
 
         return hidden, cell
 
+    def allocate_buffers(self, batch_size, num_records):
+        """
+        Keep the encoded records of init_hidden in preallocated buffers, so that their memory stays the same
+        across batches and captured cuda graphs can be replayed. Only meant for inference.
+        """
+        param = next(self.parameters())
+        self.selected_content_buf = torch.zeros(batch_size, num_records, self.hidden_size, dtype=param.dtype,
+                                                device=param.device)
+        self.content_tp_buf = torch.zeros(batch_size, self.hidden_size, num_records, dtype=param.dtype,
+                                          device=param.device)
+
+    def free_buffers(self):
+        """
+        Go back to allocating new tensors for the encoded records on every call of init_hidden.
+        """
+        self.selected_content_buf = self.content_tp_buf = None
+
 ###############################################################################
 # Training & Evaluation functions                                             #
 ###############################################################################
 
 
-def train_planner(extractor, epochs=25, learning_rate=0.15, acc_val_init=0.1,
+def train_planner(extractor, batch_size=32, epochs=25, learning_rate=0.15, acc_val_init=0.1,
                   clip=7, teacher_forcing_ratio=1.0, log_interval=100):
     data = load_planner_data("train", extractor)
-    loader = DataLoader(data, shuffle=True, pin_memory=torch.cuda.is_available())  # online learning
+    # batches are assembled and pinned by background workers, so that the host to device copies can overlap
+    loader = DataLoader(data, shuffle=True, batch_size=batch_size, collate_fn=data.collate, num_workers=4,
+                        persistent_workers=True, prefetch_factor=4, pin_memory=torch.cuda.is_available())
 
     content_planner = ContentPlanner(len(data.idx2word)).to(device)
+    # compile the forward pass on the gpu where supported, the uncompiled module is still used for everything else
+    decoder = content_planner
+    if torch.cuda.is_available() and hasattr(torch, "compile"):
+        decoder = torch.compile(content_planner)
     optimizer = optim.Adagrad(content_planner.parameters(), lr=learning_rate, initial_accumulator_value=acc_val_init)
+    # use mixed precision when training on the gpu
+    scaler = GradScaler(enabled=torch.cuda.is_available())
 
     logging.info("Training a new Content Planner...")
 
+    pad, _, _, _ = special_ids(data.vocab)
+
+    def _loss(output, record_pointers):
+        """
+        Compute the summed loss over one or more time steps and ignore padded records.
+        """
+        record_pointers = record_pointers.reshape(-1)
+        loss = F.nll_loss(output.reshape(record_pointers.size(0), -1), record_pointers, reduction="none")
+        return (loss * (record_pointers != pad)).sum()
+
     def _update(engine, batch):
         """
         Update function for the Conent Selection & Planning Module.
-        Right now only online learning is supported
+        Content plans of different length in a mini-batch are handled with masks.
         """
         content_planner.train()
-        optimizer.zero_grad()
-        use_teacher_forcing = True if random() < teacher_forcing_ratio else False
+        optimizer.zero_grad(set_to_none=True)
 
         records, content_plan = to_device(batch)
-        hidden, cell = content_planner.init_hidden(records)
-        content_plan_iterator = iter(content_plan.t())
-        input_index = next(content_plan_iterator)
-        loss = 0
-        len_sequence = 0
-
-        for record_pointer in content_plan_iterator:
-            if record_pointer.cpu() == data.vocab[PAD_WORD]:
-                break
-            output, hidden, cell = content_planner(input_index, hidden, cell)
-            loss += F.nll_loss(output, record_pointer)
-            len_sequence += 1
-            if use_teacher_forcing:
-                input_index = record_pointer
+        num_records = (content_plan[:, 1:] != pad).sum()
+
+        with autocast(enabled=torch.cuda.is_available()):
+            hidden, cell = content_planner.init_hidden(records)
+            if teacher_forcing_ratio >= 1:
+                # the input records are known in advance, so all time steps are processed at once
+                output, _, _ = decoder(content_plan[:, :-1], hidden, cell)
+                loss = _loss(output, content_plan[:, 1:])
             else:
-                input_index = output.argmax(dim=1).detach()
-
-        loss.backward()
+                losses = list()
+                # time major copy, so that every time step is a contiguous slice
+                record_pointers = content_plan.t().contiguous()
+                input_index = record_pointers[0]
+                # decide for every time step whether the gold record or the prediction is the next input
+                teacher_forcing = torch.rand(content_plan.size(1), device=device) < teacher_forcing_ratio
+                for t in range(1, content_plan.size(1)):
+                    output, hidden, cell = decoder(input_index, hidden, cell)
+                    losses.append(_loss(output, record_pointers[t]))
+                    input_index = torch.where(teacher_forcing[t], record_pointers[t], output.argmax(dim=1).detach())
+                # sum all step losses at once to keep the autograd graph flat
+                loss = torch.stack(losses).sum()
+
+        # average the summed loss of every sequence, so that the gradients keep the per sequence scale that the
+        # learning rate, initial accumulator value and clipping were tuned for
+        scaler.scale(loss / content_plan.size(0)).backward()
+        scaler.unscale_(optimizer)
         nn.utils.clip_grad_norm_(content_planner.parameters(), clip)
-        optimizer.step()
-        return loss.item() / len_sequence  # normalize loss for logging
+        scaler.step(optimizer)
+        scaler.update()
+        return (loss / num_records).item()  # normalize loss for logging
 
     trainer = Engine(_update)
     # save the model every 4 epochs
@@ -213,30 +268,44 @@ def eval_planner(extractor, content_planner, test=False):
         Logs average sizes of content plans.
         """
         content_planner.eval()
+        pad, _, bos, eos = special_ids(data.vocab)
         gen_len = 0
         gold_len = 0
         size = 0
+        # all records have the same size, so one cuda graph can be reused for every content plan
+        decode = None
+        if torch.cuda.is_available():
+            content_planner.allocate_buffers(1, data.sequence.size(1))
 
         for batch in loader:
             with torch.no_grad():
                 records, content_plan = to_device(batch)
                 hidden, cell = content_planner.init_hidden(records)
-                input_index = torch.tensor([data.vocab[BOS_WORD]], device=device)
+                input_index = torch.tensor([bos], device=device)
 
                 generated_plan = list()
-                gold_plan = content_plan[content_plan > data.vocab[PAD_WORD]][1:-1].tolist()
-
-                while len(generated_plan) < content_plan.size(1):
-                    output, hidden, cell = content_planner(input_index, hidden, cell)
+                gold_plan = content_plan[content_plan > pad][1:-1].tolist()
+                # on the gpu replay the decoding steps from a cuda graph
+                if decode is None:
+                    decode = (CUDAGraphStep(content_planner, input_index, hidden, cell) if torch.cuda.is_available()
+                              else content_planner)
+
+                for step in range(1, content_plan.size(1) + 1):
+                    output, hidden, cell = decode(input_index, hidden, cell)
                     input_index = output.argmax(dim=1)
-                    if input_index.cpu() == data.vocab[EOS_WORD]:
+                    generated_plan.append(input_index)
+                    # only synchronize with the gpu every few steps to check for the end of the content plan
+                    if step % SYNC_INTERVAL == 0 and torch.cat(generated_plan[-SYNC_INTERVAL:]).eq(eos).any():
                         break
-                    generated_plan.append(input_index.item())
+                generated_plan = torch.cat(generated_plan).tolist()
+                if eos in generated_plan:
+                    generated_plan = generated_plan[:generated_plan.index(eos)]
 
                 bleu_metric(gold_plan, generated_plan)
                 gen_len += len(generated_plan)
                 gold_len += len(gold_plan)
                 size += 1
+        content_planner.free_buffers()
         logging.info("{} Results - BLEU Score: {:.4f}".format(used_set, bleu_metric.calculate()))
         logging.info("{} Results - avg gold content plan length: {}".format(used_set, gold_len / size))
         logging.info("{} Results - avg generated content plan length: {}".format(used_set, gen_len / size))
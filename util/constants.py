@@ -2,40 +2,76 @@
 # Various Constants used throughout the network                               #
 ###############################################################################
 
-import torch
-
-HOME = "HOME"
-AWAY = "AWAY"
-
-PAD_WORD = "<pad>"
-UNK_WORD = "<unk>"
-BOS_WORD = "<s>"
-EOS_WORD = "</s>"
-
-prons = ["he", "He", "him", "Him", "his", "His", "they",
-         "They", "them", "Them", "their", "Their"]  # leave out "it"
-singular_prons = ["he", "He", "him", "Him", "his", "His"]
-plural_prons = ["they", "They", "them", "Them", "their", "Their"]
-number_words = ["one", "two", "three", "four", "five", "six", "seven", "eight", "nine",
-                "ten", "eleven", "twelve", "thirteen", "fourteen", "fifteen", "sixteen",
-                "seventeen", "eighteen", "nineteen", "twenty", "thirty", "forty", "fifty",
-                "sixty", "seventy", "eighty", "ninety", "hundred", "thousand"]
-bs_keys = ["PLAYER-PLAYER_NAME", "PLAYER-START_POSITION", "PLAYER-MIN", "PLAYER-PTS",
-           "PLAYER-FGM", "PLAYER-FGA", "PLAYER-FG_PCT", "PLAYER-FG3M", "PLAYER-FG3A",
-           "PLAYER-FG3_PCT", "PLAYER-FTM", "PLAYER-FTA", "PLAYER-FT_PCT", "PLAYER-OREB",
-           "PLAYER-DREB", "PLAYER-REB", "PLAYER-AST", "PLAYER-TO", "PLAYER-STL", "PLAYER-BLK",
-           "PLAYER-PF", "PLAYER-FIRST_NAME", "PLAYER-SECOND_NAME"]
-ls_keys = ["TEAM-PTS_QTR1", "TEAM-PTS_QTR2", "TEAM-PTS_QTR3", "TEAM-PTS_QTR4",
-           "TEAM-PTS", "TEAM-FG_PCT", "TEAM-FG3_PCT", "TEAM-FT_PCT", "TEAM-REB",
-           "TEAM-AST", "TEAM-TOV", "TEAM-WINS", "TEAM-LOSSES", "TEAM-CITY", "TEAM-NAME"]
-suffixes = ["II", "III", "Jr.", "Jr"]
-multi_word_cities = ["Golden State", "Los Angeles", "New Orleans", "Oklahoma City", "San Antonio", "New York"]
-multi_word_teams = ["Trail Blazers"]
-abbr2ent = {"Cavs": "Cavaliers", "Sixers": "76ers", "Mavs": "Mavericks", "Wolves": "Timberwolves",
-            "LA": "Los Angeles"}
-NUM_PLAYERS = 13
-MAX_RECORDS = 2 * NUM_PLAYERS * len(bs_keys) + 2 * len(ls_keys)
-
-TEXT_MAX_LENGTH = 1000
-
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+import re
+from sys import intern
+from types import MappingProxyType
+from typing import Final
+
+# all string constants are interned, so that comparisons and hashing of equal strings are cheap
+HOME = intern("HOME")
+AWAY = intern("AWAY")
+
+PAD_WORD = intern("<pad>")
+UNK_WORD = intern("<unk>")
+BOS_WORD = intern("<s>")
+EOS_WORD = intern("</s>")
+
+prons = tuple(map(intern, ("he", "He", "him", "Him", "his", "His", "they",
+                           "They", "them", "Them", "their", "Their")))  # leave out "it"
+singular_prons = tuple(map(intern, ("he", "He", "him", "Him", "his", "His")))
+plural_prons = tuple(map(intern, ("they", "They", "them", "Them", "their", "Their")))
+number_words = tuple(map(intern, ("one", "two", "three", "four", "five", "six", "seven", "eight", "nine",
+                                  "ten", "eleven", "twelve", "thirteen", "fourteen", "fifteen", "sixteen",
+                                  "seventeen", "eighteen", "nineteen", "twenty", "thirty", "forty", "fifty",
+                                  "sixty", "seventy", "eighty", "ninety", "hundred", "thousand")))
+bs_keys = tuple(map(intern, ("PLAYER-PLAYER_NAME", "PLAYER-START_POSITION", "PLAYER-MIN", "PLAYER-PTS",
+                             "PLAYER-FGM", "PLAYER-FGA", "PLAYER-FG_PCT", "PLAYER-FG3M", "PLAYER-FG3A",
+                             "PLAYER-FG3_PCT", "PLAYER-FTM", "PLAYER-FTA", "PLAYER-FT_PCT", "PLAYER-OREB",
+                             "PLAYER-DREB", "PLAYER-REB", "PLAYER-AST", "PLAYER-TO", "PLAYER-STL", "PLAYER-BLK",
+                             "PLAYER-PF", "PLAYER-FIRST_NAME", "PLAYER-SECOND_NAME")))
+ls_keys = tuple(map(intern, ("TEAM-PTS_QTR1", "TEAM-PTS_QTR2", "TEAM-PTS_QTR3", "TEAM-PTS_QTR4",
+                             "TEAM-PTS", "TEAM-FG_PCT", "TEAM-FG3_PCT", "TEAM-FT_PCT", "TEAM-REB",
+                             "TEAM-AST", "TEAM-TOV", "TEAM-WINS", "TEAM-LOSSES", "TEAM-CITY", "TEAM-NAME")))
+suffixes = tuple(map(intern, ("II", "III", "Jr.", "Jr")))
+multi_word_cities = tuple(map(intern, ("Golden State", "Los Angeles", "New Orleans", "Oklahoma City", "San Antonio",
+                                       "New York")))
+multi_word_teams = tuple(map(intern, ("Trail Blazers",)))
+# read-only, so that the mapping can't be modified accidentally
+abbr2ent = MappingProxyType({intern(abbr): intern(ent) for abbr, ent in {
+    "Cavs": "Cavaliers", "Sixers": "76ers", "Mavs": "Mavericks", "Wolves": "Timberwolves",
+    "LA": "Los Angeles"}.items()})
+
+
+# replace all abbreviations in a single pass, longer abbreviations take precedence
+ABBR_PATTERN = re.compile("|".join(map(re.escape, sorted(abbr2ent, key=len, reverse=True))))
+
+# sets for fast membership tests, the tuples above keep the order for iteration
+PRONS = frozenset(prons)
+SINGULAR_PRONS = frozenset(singular_prons)
+PLURAL_PRONS = frozenset(plural_prons)
+NUMBER_WORDS = frozenset(number_words)
+NUMBER_WORD_VALUE = MappingProxyType(dict(zip(number_words, (*range(1, 21), *range(30, 100, 10), 100, 1000))))
+SUFFIXES = frozenset(suffixes)
+MULTI_WORD_CITIES = frozenset(multi_word_cities)
+MULTI_WORD_TEAMS = frozenset(multi_word_teams)
+MULTI_WORD_IDENTS = MULTI_WORD_CITIES | MULTI_WORD_TEAMS
+# first words of the multi-word identifiers, so that most tokens can be ruled out without joining them
+MULTI_WORD_STARTS = frozenset(ident.split()[0] for ident in MULTI_WORD_IDENTS)
+# maps every word of a multi-word city or team to the first identifier it is part of
+# (iterated in reverse, so that earlier identifiers overwrite later ones)
+MULTI_WORD_PIECES = {piece: ident for ident in reversed(multi_word_cities + multi_word_teams) for piece in ident.split()}
+BS_KEYS = frozenset(bs_keys)
+LS_KEYS = frozenset(ls_keys)
+
+NUM_PLAYERS: Final[int] = 13
+MAX_RECORDS: Final[int] = 2 * NUM_PLAYERS * len(bs_keys) + 2 * len(ls_keys)
+# layout of the records of every entry (without special records): the box scores of all home and away players
+# followed by the line scores of the home and away team. Key indices refer to bs_keys + ls_keys
+RECORD_KEY_IDX = (tuple(range(len(bs_keys))) * 2 * NUM_PLAYERS
+                  + tuple(range(len(bs_keys), len(bs_keys) + len(ls_keys))) * 2)
+RECORD_IS_HOME = ((True,) * NUM_PLAYERS * len(bs_keys) + (False,) * NUM_PLAYERS * len(bs_keys)
+                  + (True,) * len(ls_keys) + (False,) * len(ls_keys))
+
+TEXT_MAX_LENGTH: Final[int] = 1000
+# when decoding, only check every few steps whether a sequence is finished to reduce gpu synchronizations
+SYNC_INTERVAL: Final[int] = 16
@@ -0,0 +1,39 @@
+###############################################################################
+# Captures single decoding steps in cuda graphs to remove the kernel launch   #
+# overhead of greedy decoding                                                 #
+###############################################################################
+
+import torch
+
+
+class CUDAGraphStep():
+    """
+    Captures one forward pass of a module in a cuda graph and replays it on
+    every call. The inputs are copied into static tensors and the returned
+    outputs are static tensors as well, which are overwritten by the next call.
+    Only works for inputs with the same shape and no gradient tracking.
+    """
+    graph = None
+    inputs = None
+    outputs = None
+
+    def __init__(self, module, *inputs, warmup=3):
+        self.inputs = [tensor.clone() for tensor in inputs]
+
+        # warm up on a side stream, so that lazy initializations aren't captured
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(warmup):
+                module(*self.inputs)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.outputs = module(*self.inputs)
+
+    def __call__(self, *inputs):
+        for static_input, tensor in zip(self.inputs, inputs):
+            static_input.copy_(tensor)
+        self.graph.replay()
+        return self.outputs
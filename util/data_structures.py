@@ -4,6 +4,7 @@
 
 from collections import Counter, OrderedDict
 from torch.utils.data.dataset import Dataset
+from torch.utils.data.dataloader import default_collate
 from .constants import PAD_WORD, UNK_WORD, BOS_WORD, EOS_WORD
 
 
@@ -115,6 +116,16 @@ class SequenceDataset(Dataset):
     def __len__(self):
         return (len(self.sequence))
 
+    def collate(self, batch):
+        """
+        Merge a list of entries to a mini-batch and cut off the padding
+        that all content plans of the batch have in common
+        """
+        records, content_plan = default_collate(batch)
+        length = (content_plan != self.vocab[PAD_WORD]).sum(dim=1).max()
+
+        return records, content_plan[:, :length]
+
 
 class CopyDataset(SequenceDataset):
     """
@@ -124,14 +135,31 @@ class CopyDataset(SequenceDataset):
     copy_indices = None
     copy_values = None
     records = None
+    plan_lengths = None
 
     def __init__(self, sequence, p_copy, copy_indices, copy_values, records, content_plan, vocab, idx2word, idx_list):
         super().__init__(sequence, content_plan, vocab, idx2word, idx_list)
         self.p_copy = p_copy
-        self.copy_indices = copy_indices
+        # spread the copy indices over all timesteps, so that every copied word
+        # is aligned with its index (non-copy positions are masked out later)
+        self.copy_indices = copy_indices.gather(1, (p_copy.long().cumsum(dim=1) - 1).clamp(min=0))
         self.copy_values = copy_values
         self.records = records
+        # pack_padded_sequence expects the lengths on the cpu, even if the content plans were saved on the gpu
+        self.plan_lengths = (content_plan != vocab[PAD_WORD]).sum(dim=1).cpu()
 
     def __getitem__(self, idx):
         return (self.sequence[idx], self.p_copy[idx], self.records[idx], self.content_plan[idx],
-                self.copy_indices[idx], self.copy_values[idx])
+                self.copy_indices[idx], self.copy_values[idx], self.plan_lengths[idx])
+
+    def collate(self, batch):
+        """
+        Merge a list of entries to a mini-batch and cut off the padding that
+        all summaries and content plans of the batch have in common
+        """
+        text, p_copy, records, content_plan, copy_indices, copy_values, plan_lengths = default_collate(batch)
+        text_length = (text != self.vocab[PAD_WORD]).sum(dim=1).max()
+        plan_length = plan_lengths.max()
+
+        return (text[:, :text_length], p_copy[:, :text_length], records, content_plan[:, :plan_length],
+                copy_indices[:, :text_length], copy_values[:, :plan_length], plan_lengths)
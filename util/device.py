@@ -0,0 +1,28 @@
+###############################################################################
+# Selection of the torch device, kept apart from the plain constants          #
+###############################################################################
+
+import torch
+from functools import lru_cache
+
+# creating device objects doesn't touch the driver, so they can be shared right away
+DEVICE_CPU = torch.device("cpu")
+_DEVICE_CUDA = torch.device("cuda")
+
+
+@lru_cache(maxsize=1)
+def get_device():
+    """
+    Selects the device lazily, as probing for cuda initializes the driver.
+    """
+    return _DEVICE_CUDA if torch.cuda.is_available() else DEVICE_CPU
+
+
+def __getattr__(name):
+    """
+    Allows to import the device like a constant, it is selected on first access.
+    DEVICE_CUDA falls back to the cpu when cuda isn't available.
+    """
+    if name in ("DEVICE", "DEVICE_CUDA", "device"):
+        return get_device()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -11,8 +11,9 @@ from torch.nn.utils.rnn import pad_sequence
 from nltk import sent_tokenize
 from os import path, makedirs
 from json import loads
-from .constants import device, TEXT_MAX_LENGTH, PAD_WORD, BOS_WORD, EOS_WORD, multi_word_cities, multi_word_teams
-from .helper_funcs import extract_entities, extract_numbers, to_device, preproc_text
+from .device import device
+from .constants import TEXT_MAX_LENGTH, SYNC_INTERVAL, BOS_WORD, EOS_WORD, MULTI_WORD_IDENTS, MULTI_WORD_STARTS
+from .helper_funcs import extract_entities, extract_numbers, to_device, preproc_text, special_ids
 from .planner import load_planner_data, generate_template_plans
 from .data_structures import OrderedCounter, Vocab, CopyDataset
 
@@ -25,7 +26,8 @@ def make_content_plan(planner, dataset):
     data_dim2 = dataset.sequence.size(1)
     # size = (#entries, records, hidden_size)
     content_plans = torch.zeros(data_dim1, data_dim2, dtype=torch.long, device=device)
-    bos_tensor = torch.tensor([dataset.vocab[BOS_WORD]], device=device)
+    _, _, bos, eos = special_ids(dataset.vocab)
+    bos_tensor = torch.tensor([bos], device=device)
     planner.eval()
     planner.to(device)
 
@@ -48,7 +50,7 @@ def make_content_plan(planner, dataset):
                             break
                 else:
                     record_index = output.argmax(dim=1)
-                if record_index == dataset.vocab[EOS_WORD]:
+                if record_index == eos:
                     break
                 # must be unique and shouldn't be unavailable
                 if dataset.idx2word[records[record_index][0][2].item()] != "N/A" and record_index not in already_added:
@@ -69,6 +71,7 @@ def make_train_content_plan(dataset):
     data_dim2 = dataset.content_plan.where(dataset.content_plan == 0, torch.tensor([1])).sum(dim=1).max()
     # size = (#entries, records, hidden_size)
     content_plans = torch.zeros(data_dim1, data_dim2, dtype=torch.long, device=device)
+    _, _, _, eos = special_ids(dataset.vocab)
 
     with torch.no_grad():
         for dim1 in range(len(dataset)):
@@ -77,7 +80,7 @@ def make_train_content_plan(dataset):
             next(content_plan_iterator)  # skip BOS word
 
             for dim2, record_index in enumerate(content_plan_iterator):
-                if record_index == dataset.vocab[EOS_WORD]:
+                if record_index == eos:
                     # ugly workaround when the content plan is empty (only happens in one case)
                     # in this case add an unrelated record to avoid an empty content plan
                     if dim2 == 0:
@@ -163,7 +166,7 @@ def get_copy_probs(summary, entry_indices, records, vocab, idx2word):
         i = 0
         while i < len(split_sent):
             # reassemble multi-word cities/teams
-            if " ".join(split_sent[i:i + 2]) in multi_word_cities + multi_word_teams:
+            if split_sent[i] in MULTI_WORD_STARTS and " ".join(split_sent[i:i + 2]) in MULTI_WORD_IDENTS:
                 tokes.append(" ".join(split_sent[i:i + 2]))
                 i += 2
             # sometimes name abbrevations don't contain dots in the dataset
@@ -331,30 +334,35 @@ class TextGeneratorWrapper():
     def generate_text(self, index):
         vocab = self.dataset.vocab
         idx2word = self.dataset.idx2word
-        entry = self.dataset[index]
-        _, _, records, content_plan, _, copy_values = entry
+        _, _, records, content_plan, _, copy_values, plan_lengths = self.dataset.collate([self.dataset[index]])
 
-        records, content_plan, copy_values = to_device([records.unsqueeze(0),
-                                                        content_plan.unsqueeze(0), copy_values.unsqueeze(0)])
-        # remove all the zero padded values from the content plans
-        content_plan = content_plan[:, :(content_plan > vocab[PAD_WORD]).sum(dim=1)]
-        hidden, cell = self.generator.init_hidden(records, content_plan)
+        records, content_plan, copy_values = to_device([records, content_plan, copy_values])
+        hidden, cell = self.generator.init_hidden(records, content_plan, plan_lengths)
 
-        input_word = torch.tensor([vocab[BOS_WORD]], device=device)
-        text = []
+        _, _, bos, eos = special_ids(vocab)
+        input_word = torch.tensor([bos], device=device)
+        words = []
+        copied = []
 
         with torch.no_grad():
-            while input_word.cpu() != vocab[EOS_WORD] and len(text) <= TEXT_MAX_LENGTH:
-                out_prob, copy_prob, p_copy, hidden, cell = self.generator(
+            for step in range(1, TEXT_MAX_LENGTH + 2):
+                out_prob, copy_prob, copy_logit, hidden, cell = self.generator(
                     input_word, hidden, cell)
-                if p_copy > 0.5:
-                    input_word = copy_values[:, copy_prob.argmax(dim=1)].view(1)
-                else:
-                    input_word = out_prob.argmax(dim=1)
-                text.append((p_copy > 0.5, input_word.item()))
+                copied_word = copy_values.gather(1, copy_prob.argmax(dim=1, keepdim=True)).view(-1)
+                p_copy = torch.sigmoid(copy_logit.view(-1))
+                input_word = torch.where(p_copy > 0.5, copied_word, out_prob.argmax(dim=1))
+                words.append(input_word)
+                copied.append(p_copy > 0.5)
+                # only synchronize with the gpu every few steps to check for the end of the summary
+                if step % SYNC_INTERVAL == 0 and torch.cat(words[-SYNC_INTERVAL:]).eq(eos).any():
+                    break
+
+        words = torch.cat(words).tolist()
+        length = words.index(eos) if eos in words else len(words) - 1
+        text = list(zip(torch.cat(copied).tolist(), words))[:length]
 
         # copied values are marked with bold markdown syntax
-        markup = ["**" + idx2word[idx] + "**" if p_copy else idx2word[idx] for p_copy, idx in text[:-1]]
-        normal = [idx2word[idx] for _, idx in text[:-1]]
+        markup = ["**" + idx2word[idx] + "**" if p_copy else idx2word[idx] for p_copy, idx in text]
+        normal = [idx2word[idx] for _, idx in text]
 
         return markup, normal
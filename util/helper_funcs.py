@@ -6,9 +6,11 @@
 
 from word2number import w2n
 from nltk import sent_tokenize
-from .constants import (singular_prons, plural_prons, number_words, prons, device, suffixes, abbr2ent,
-                        multi_word_cities, multi_word_teams, NUM_PLAYERS)
+from .constants import (SINGULAR_PRONS, PLURAL_PRONS, NUMBER_WORDS, NUMBER_WORD_VALUE, PRONS, SUFFIXES, abbr2ent,
+                        ABBR_PATTERN, MULTI_WORD_IDENTS, MULTI_WORD_STARTS, MULTI_WORD_PIECES,
+                        NUM_PLAYERS, PAD_WORD, UNK_WORD, BOS_WORD, EOS_WORD)
 from .data_structures import DefaultListOrderedDict
+from .device import get_device
 
 
 def get_ents(dat):
@@ -42,7 +44,7 @@ def get_ents(dat):
             pieces = k.split()
             if len(pieces) > 1:
                 for piece in pieces:
-                    if len(piece) > 1 and piece not in suffixes:
+                    if len(piece) > 1 and piece not in SUFFIXES:
                         entset.add(piece)
 
     all_ents = players | teams | cities
@@ -55,22 +57,22 @@ def deterministic_resolve(pron, players, teams, cities, curr_ents, prev_ents, ma
     # first look in current sentence; if there's an antecedent here return None, since
     # we'll catch it anyway
     for j in range(len(curr_ents) - 1, -1, -1):
-        if pron in singular_prons and curr_ents[j][2] in players:
+        if pron in SINGULAR_PRONS and curr_ents[j][2] in players:
             return None
-        elif pron in plural_prons and curr_ents[j][2] in teams:
+        elif pron in PLURAL_PRONS and curr_ents[j][2] in teams:
             return None
-        elif pron in plural_prons and curr_ents[j][2] in cities:
+        elif pron in PLURAL_PRONS and curr_ents[j][2] in cities:
             return None
 
     # then look in previous max_back sentences
     if len(prev_ents) > 0:
         for i in range(len(prev_ents) - 1, len(prev_ents) - 1 - max_back, -1):
             for j in range(len(prev_ents[i]) - 1, -1, -1):
-                if pron in singular_prons and prev_ents[i][j][2] in players:
+                if pron in SINGULAR_PRONS and prev_ents[i][j][2] in players:
                     return prev_ents[i][j]
-                elif pron in plural_prons and prev_ents[i][j][2] in teams:
+                elif pron in PLURAL_PRONS and prev_ents[i][j][2] in teams:
                     return prev_ents[i][j]
-                elif pron in plural_prons and prev_ents[i][j][2] in cities:
+                elif pron in PLURAL_PRONS and prev_ents[i][j][2] in cities:
                     return prev_ents[i][j]
     return None
 
@@ -127,9 +129,9 @@ def extract_numbers(sent):
             sent_nums.append((i, i + 1, int(toke)))
             i += 1
         # get longest span  (this is kind of stupid)
-        elif toke in number_words and not annoying_number_word(sent, i):
+        elif toke in NUMBER_WORDS and not annoying_number_word(sent, i):
             j = 1
-            while i + j < len(sent) and sent[i + j] in number_words and not annoying_number_word(sent, i + j):
+            while i + j < len(sent) and sent[i + j] in NUMBER_WORDS and not annoying_number_word(sent, i + j):
                 j += 1
             sent_nums.append((i, i + j, w2n.word_to_num(" ".join(sent[i:i + j]))))
             i += j
@@ -225,19 +227,17 @@ def resolve_abbr(text):
     """
     Replace abbrevations with their full identifier
     """
-    for key, value in abbr2ent.items():
-        text = text.replace(key, value)
+    text = ABBR_PATTERN.sub(lambda match: abbr2ent[match.group()], text)
     split_text = text.split(" ")
     tokes = []
     i = 0
     while i < len(split_text):
-        if " ".join(split_text[i:i + 2]) in multi_word_cities + multi_word_teams:
+        if split_text[i] in MULTI_WORD_STARTS and " ".join(split_text[i:i + 2]) in MULTI_WORD_IDENTS:
             tokes.extend(split_text[i:i + 2])
             i += 2
         # substitute 1 word identifiers for multi-word cities/teams
-        elif any(split_text[i] in ident.split() for ident in multi_word_cities + multi_word_teams):
-            tokes.append(next(ident for ident in multi_word_cities + multi_word_teams
-                              if split_text[i] in ident.split()))
+        elif split_text[i] in MULTI_WORD_PIECES:
+            tokes.append(MULTI_WORD_PIECES[split_text[i]])
             i += 1
         else:
             tokes.append(split_text[i])
@@ -253,14 +253,10 @@ def preproc_text(text):
     split_text = resolve_abbr(text)
     i = 0
     while i < len(split_text):
-        # replace every number word with the corresponding digits
-        if split_text[i] in number_words and not annoying_number_word(split_text, i):
-            j = 1
-            while i + j < len(split_text) and split_text in number_words and not annoying_number_word(split_text,
-                                                                                                      i + j):
-                j += 1
-            tokes.append(str(w2n.word_to_num(" ".join(split_text[i:i + j]))))
-            i += j
+        # replace every number word with the corresponding digits, one word at a time like in the preprocessed data
+        if split_text[i] in NUMBER_WORDS and not annoying_number_word(split_text, i):
+            tokes.append(str(NUMBER_WORD_VALUE[split_text[i]]))
+            i += 1
         else:
             tokes.append(split_text[i])
             i += 1
@@ -292,7 +288,7 @@ def get_candidate_rels(dataset):
         candrels = []
         for entry in entries:
             summ = " ".join(entry['summary'])
-            candrels.append(append_candidate_rels(entry, summ, prons, all_ents, players, teams, cities))
+            candrels.append(append_candidate_rels(entry, summ, PRONS, all_ents, players, teams, cities))
 
         extracted_stuff[corpus_type] = candrels
 
@@ -357,4 +353,12 @@ def get_player_idxs(entry):
 
 
 def to_device(tensor_list):
+    device = get_device()
     return [t.to(device, non_blocking=True) for t in tensor_list]
+
+
+def special_ids(vocab):
+    """
+    Look up the indices of the special words once, e.g. before a decoding loop.
+    """
+    return vocab[PAD_WORD], vocab[UNK_WORD], vocab[BOS_WORD], vocab[EOS_WORD]
@@ -12,7 +12,8 @@ from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction
 from pyxdameraulevenshtein import normalized_damerau_levenshtein_distance
 from .helper_funcs import get_ents, append_candidate_rels, append_multilabeled_data
 from .extractor import load_extractor_data
-from .constants import prons, ls_keys, bs_keys, device
+from .constants import PRONS, LS_KEYS, BS_KEYS
+from .device import device
 from .data_structures import Vocab
 from collections import OrderedDict
 
@@ -91,7 +92,7 @@ class ExtractiveMetric(ABC):
             label = self.idx2type[labels.argmax(dim=1)[label_idx].item()]
             if label != "NONE":
                 if resolve_record:  # check if the record really exists in the dataset
-                    if type(entry_idx) == bool and label in ls_keys:  # it's a team record
+                    if type(entry_idx) == bool and label in LS_KEYS:  # it's a team record
                         if entry_idx:  # it's the home team
                             if entry["home_line"][label] == str(num[2]):
                                 team = entry["home_line"]["TEAM-CITY"] + " " + entry["home_line"]["TEAM-NAME"]
@@ -100,7 +101,7 @@ class ExtractiveMetric(ABC):
                             if entry["vis_line"][label] == str(num[2]):
                                 team = entry["vis_line"]["TEAM-CITY"] + " " + entry["vis_line"]["TEAM-NAME"]
                                 extracted.append((team, num[2], label))
-                    elif type(entry_idx) == str and label in bs_keys:  # if string, the record is a player record
+                    elif type(entry_idx) == str and label in BS_KEYS:  # if string, the record is a player record
                         # remove the "PLAYER-" prefix because the creators of the dataset didn't use that there
                         if entry["box_score"][label.replace("PLAYER-", "")][entry_idx] == str(num[2]):
                             player = entry["box_score"]["PLAYER_NAME"][entry_idx]
@@ -123,7 +124,7 @@ class ExtractiveMetric(ABC):
         summary = " ".join(summary)
         entry = self.dataset[idx]
         extracted = list()
-        candrel = append_candidate_rels(entry, summary, prons, *self.entities)
+        candrel = append_candidate_rels(entry, summary, PRONS, *self.entities)
         if len(candrel) != 0:
             # this is a critical section. sometimes when the extracted candrels are too many (e.g. the generated text
             # is garbage and contains no punctuation) not enough space would be available and the program would crash
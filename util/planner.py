@@ -8,13 +8,14 @@ import pickle
 import torch
 import logging
 from torch.nn.utils.rnn import pad_sequence
-from word2number import w2n
 from os import path, makedirs
 from json import loads
 from .constants import (PAD_WORD, UNK_WORD, BOS_WORD, EOS_WORD, NUM_PLAYERS, bs_keys,
-                        ls_keys, device, number_words, HOME, AWAY, MAX_RECORDS)
+                        ls_keys, NUMBER_WORD_VALUE, HOME, AWAY, MAX_RECORDS,
+                        RECORD_KEY_IDX, RECORD_IS_HOME)
 from .data_structures import Vocab, DefaultListOrderedDict, SequenceDataset
 from .helper_funcs import get_player_idxs, to_device
+from .device import device
 from .extractor import load_extractor_data
 
 
@@ -132,7 +133,8 @@ def match_records(entity, type_, value, matched_records, already_added):
     for idx, record in matched_records:
         # if type and values match a record exists and can be
         # used in the content plan for the planning module
-        if type_ == record[1] and (value == record[2] or (value in number_words and str(w2n.word_to_num(value)) == record[2])):
+        if type_ == record[1] and (value == record[2] or (value in NUMBER_WORD_VALUE
+                                                          and str(NUMBER_WORD_VALUE[value]) == record[2])):
             matched = True
             # name should be added only once
             if record[0] not in already_added:
@@ -224,13 +226,17 @@ def preproc_planner_data(corpus_type, extractor, folder="boxscore-data", dataset
             entry_records, _ = create_records(raw_entry)
         content_plan = create_content_plan(pre_content_plan, entry_records, vocab)
 
-        # translate words to indices and create tensors
+        # translate words to indices and create tensors, keys and teams are filled in below
         for entity_records in entry_records.values():
             for dim2, record in entity_records:
-                for dim3, word in enumerate(record):
-                    records[dim1][dim2][dim3] = vocab[word]
+                records[dim1][dim2][0] = vocab[record[0]]
+                records[dim1][dim2][2] = vocab[record[2]]
         for dim2, record_idx in enumerate(content_plan):
             content_plans[dim1][dim2] = record_idx
+    # keys and teams are at the same positions in every entry (special records only contain padding there)
+    key_idxs = torch.tensor([vocab[key] for key in bs_keys + ls_keys])
+    records[:, -MAX_RECORDS:, 1] = key_idxs[list(RECORD_KEY_IDX)]
+    records[:, -MAX_RECORDS:, 3] = torch.tensor([vocab[HOME] if home else vocab[AWAY] for home in RECORD_IS_HOME])
     # pad lists of tensors to tensor of equal length
     records = pad_sequence(records, batch_first=True)
     content_plans = pad_sequence(content_plans, batch_first=True)